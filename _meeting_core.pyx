@@ -0,0 +1,125 @@
+# cython: boundscheck=False, wraparound=False, language_level=3
+import numpy as np
+from strategy import QLearning
+
+# Compiled game loop of a Meeting, for any pair of strategies. QLearning players are played with typed code,
+# following QLearning.get_action and QLearning.update on the same flat Q table
+# q[(my_past_action << 2) | (their_past_action << 1) | action]; other strategies are called through their methods.
+
+
+cdef class _Learner:
+    '''
+    Typed state of a QLearning player for the length of a meeting, sharing its Q table.
+    '''
+    cdef object s
+    cdef float[::1] q
+    cdef double[::1] eps
+    cdef float[::1] alpha
+    cdef double[::1] uniforms
+    cdef signed char[::1] randbits
+    cdef double gamma
+    cdef int mypast, theirpast
+    cdef bint done
+
+    def __init__(self, s, int length):
+        self.s = s
+        self.q = s.q_flat
+        self.eps = s.epsilon_schedule(length)
+        self.alpha = s.learning_rates(length)
+        # random numbers of the epsilon-greedy policy
+        self.uniforms = np.random.random(length)
+        self.randbits = np.random.randint(0, 2, length, dtype=np.int8)
+        self.gamma = s.gamma
+        self.mypast = s.mypast
+        self.theirpast = s.theirpast
+        self.done = s.done
+
+    cdef int choose(self, int iteration):
+        # decaying epsilon greedy policy: first action is random, then follow the Q table with probability 1-epsilon
+        cdef int state
+        if iteration == 0 or self.uniforms[iteration] < self.eps[iteration]:
+            return self.randbits[iteration]
+        state = (self.mypast << 2) | (self.theirpast << 1)
+        return 1 if self.q[state | 1] > self.q[state] else 0
+
+    cdef void learn(self, int my, int their, double r, int iteration):
+        # Q-learning update of the past state and current action
+        cdef int idx = (self.mypast << 2) | (self.theirpast << 1) | my
+        cdef int state = (my << 2) | (their << 1)
+        cdef double deltaQ
+        if self.done:
+            deltaQ = r - self.q[idx]
+        else:
+            deltaQ = r + self.gamma * max(self.q[state], self.q[state | 1]) - self.q[idx]
+        self.q[idx] += self.alpha[iteration] * deltaQ
+        self.mypast = my
+        self.theirpast = their
+
+    cdef void restore(self, int length):
+        # copy back the state of the player, the Q table was updated in place
+        self.s.mypast = self.mypast
+        self.s.theirpast = self.theirpast
+        self.s.done = self.done
+        if length > 0:
+            self.s.iteration = length - 1
+
+
+cdef (long, long) _play_games(int[:, ::1] px, int[:, ::1] py, int start, int stop, object s1, _Learner l1,
+                              object s2, _Learner l2, signed char[::1] h1, signed char[::1] h2):
+    # play the games from 'start' to 'stop', returning the cumulative reward of each player
+    cdef long score1 = 0, score2 = 0
+    cdef int iteration, c1, c2
+    for iteration in range(start, stop):
+        # get each players' action
+        c1 = s1.get_action(iteration) if l1 is None else l1.choose(iteration)
+        c2 = s2.get_action(iteration) if l2 is None else l2.choose(iteration)
+        h1[iteration] = c1
+        h2[iteration] = c2
+        # tell each other their past action, QLearning players are rewarded as the row player
+        if l1 is None:
+            s1.update(c1, c2)
+        else:
+            l1.learn(c1, c2, px[c1, c2], iteration)
+        if l2 is None:
+            s2.update(c2, c1)
+        else:
+            l2.learn(c2, c1, px[c2, c1], iteration)
+        # add payoff to cumulative reward
+        score1 += px[c1, c2]
+        score2 += py[c1, c2]
+    return score1, score2
+
+
+cpdef run_scalar(int[:, ::1] px, int[:, ::1] py, int length, object s1, object s2):
+    '''
+    Play 'length' games between 's1' and 's2', with payoff matrices 'px', 'py' of the row and column player.
+
+    Returns:
+        Tuple: scores and history of actions of the two players.
+    '''
+    cdef _Learner l1 = _Learner(s1, length) if type(s1) is QLearning else None
+    cdef _Learner l2 = _Learner(s2, length) if type(s2) is QLearning else None
+    hist1 = np.empty(length, dtype=np.int8)
+    hist2 = np.empty(length, dtype=np.int8)
+    cdef long score1, score2, last1, last2
+
+    # all games but the last one, then the last one after setting players' 'done' flag to True
+    score1, score2 = _play_games(px, py, 0, length - 1, s1, l1, s2, l2, hist1, hist2)
+    if length > 0:
+        if l1 is None:
+            s1.done = True
+        else:
+            l1.done = True
+        if l2 is None:
+            s2.done = True
+        else:
+            l2.done = True
+        last1, last2 = _play_games(px, py, length - 1, length, s1, l1, s2, l2, hist1, hist2)
+        score1 += last1
+        score2 += last2
+
+    if l1 is not None:
+        l1.restore(length)
+    if l2 is not None:
+        l2.restore(length)
+    return score1, score2, hist1, hist2
@@ -0,0 +1,87 @@
+import numpy as np
+from numba import njit
+
+# Compiled version of a whole Meeting between two QLearning players.
+# It follows step by step QLearning.get_action and QLearning.update, with the flat Q tables indexed as
+# q[(my_past_action << 2) | (their_past_action << 1) | action] and the payoff matrices as payoff[row_action, column_action].
+# The parameters of each player are passed as a tuple, unpacked in _play_games (see Meeting._kernel_params):
+#     (q_flat, gamma, epsilon schedule, learning rates, uniforms, random bits)
+# and its past actions as an array [my_past, their_past].
+# The random numbers of the epsilon-greedy policy are drawn beforehand with np.random, so that seeding it
+# reproduces the meeting as with the other game loops.
+
+
+@njit(cache=True, inline='always')
+def _choose(q, mypast, theirpast, eps, uniforms, randbits, iteration):
+    # decaying epsilon greedy policy: first action is random, then follow the Q table with probability 1-epsilon
+    if iteration == 0 or uniforms[iteration] < eps[iteration]:
+        return randbits[iteration]
+    state = (mypast << 2) | (theirpast << 1)
+    return int(q[state | 1] > q[state])
+
+
+@njit(cache=True, inline='always')
+def _learn(q, mypast, theirpast, my, their, r, gamma, alpha, done):
+    # Q-learning update of the past state and current action
+    idx = (mypast << 2) | (theirpast << 1) | my
+    if done:
+        deltaQ = r - q[idx]
+    else:
+        state = (my << 2) | (their << 1)
+        deltaQ = r + gamma * max(q[state], q[state | 1]) - q[idx]
+    q[idx] += alpha * deltaQ
+
+
+@njit(cache=True, inline='always')
+def _play_games(payoff_x, start, stop, params1, params2, past1, past2, done1, done2, hist1, hist2):
+    # play the games from 'start' to 'stop' with the given 'done' flags, saving the actions in the histories
+    q1, gamma1, eps1, alpha1, uniforms1, randbits1 = params1
+    q2, gamma2, eps2, alpha2, uniforms2, randbits2 = params2
+    mypast1, theirpast1 = past1[0], past1[1]
+    mypast2, theirpast2 = past2[0], past2[1]
+    for iteration in range(start, stop):
+        c1 = _choose(q1, mypast1, theirpast1, eps1, uniforms1, randbits1, iteration)
+        c2 = _choose(q2, mypast2, theirpast2, eps2, uniforms2, randbits2, iteration)
+        hist1[iteration] = c1
+        hist2[iteration] = c2
+
+        # each player is rewarded as the row player of the payoff matrix
+        _learn(q1, mypast1, theirpast1, c1, c2, payoff_x[c1, c2], gamma1, alpha1[iteration], done1)
+        _learn(q2, mypast2, theirpast2, c2, c1, payoff_x[c2, c1], gamma2, alpha2[iteration], done2)
+        mypast1, theirpast1 = c1, c2
+        mypast2, theirpast2 = c2, c1
+    past1[0], past1[1] = mypast1, theirpast1
+    past2[0], past2[1] = mypast2, theirpast2
+
+
+@njit(cache=True)
+def run_meeting_ql_ql(payoff_x, payoff_y, length, params1, params2, past1, past2, done1, done2):
+    '''
+    Play 'length' games between two QLearning players, selecting the actions and updating the Q tables in the same loop.
+    The Q tables in 'params1', 'params2' and the past actions 'past1', 'past2' are updated in place,
+    'done1', 'done2' are the players' 'done' flags before the last game.
+
+    Returns:
+        Tuple: scores, number of cooperations and history of actions of the two players.
+    '''
+    hist1 = np.empty(length, dtype=np.int8)
+    hist2 = np.empty(length, dtype=np.int8)
+
+    # all games but the last one, then the last one with the 'done' flags set to True
+    _play_games(payoff_x, 0, length - 1, params1, params2, past1, past2, done1, done2, hist1, hist2)
+    if length > 0:
+        _play_games(payoff_x, length - 1, length, params1, params2, past1, past2, True, True, hist1, hist2)
+
+    # actions are 0 (cooperate) or 1 (defect), and the indexes of the payoff matrices
+    score1 = 0
+    score2 = 0
+    coop1 = 0
+    coop2 = 0
+    for iteration in range(length):
+        c1 = hist1[iteration]
+        c2 = hist2[iteration]
+        coop1 += 1 - c1
+        coop2 += 1 - c2
+        score1 += payoff_x[c1, c2]
+        score2 += payoff_y[c1, c2]
+    return score1, score2, coop1, coop2, hist1, hist2
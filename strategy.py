@@ -1,6 +1,20 @@
 import random
+from array import array
 import numpy as np
 
+# number of random draws made at once when the length of the meeting is unknown
+BATCH_SIZE = 1000
+
+
+def _batch_size(length, iteration):
+    '''
+    Number of random draws needed from 'iteration' on: the whole meeting if its length is known, a batch otherwise.
+    '''
+    if length is not None and iteration < length:
+        return length
+    return iteration + BATCH_SIZE
+
+
 class Strategy:
     '''
     Parent class for all strategies.
@@ -54,9 +68,19 @@ class Random(Strategy):
     def __init__(self):
         super().__init__()
         self.name = "random"
+        # reservoir of random bits, one per action, and number of bits left
+        self._bits = 0
+        self._n = 0
 
     def get_action(self, iteration):
-        return random.choice([0, 1])
+        # draw 64 actions at once when they run out
+        if self._n == 0:
+            self._bits = random.getrandbits(64)
+            self._n = 64
+        action = self._bits & 1
+        self._bits >>= 1
+        self._n -= 1
+        return action
 
     def clone(self):
         return Random()
@@ -90,44 +114,91 @@ class QLearning(Strategy):
         - epsilon (optional): parameter for the epsilon-greedy policy, set between 0 and 1. It is the probability of taking a random action 
                 instead of following the Q-table. Defaults to 0.2.
         - decay (optional): parameter for the decaying epsilon-greedy policy. It is the factor by which 'epsilon' is multiplied at each step, 
-                reducing it until reaching a minimum of 0.1. Defaults to 1 (non-decaying).
+                reducing it until reaching a minimum of 0.1. Defaults to 1 (non-decaying). 
+                After a meeting, the 'epsilon' attribute holds the decayed value of the last game played.
+        - length (optional): number of games it will play, to draw all the random numbers of the epsilon-greedy policy at once. 
+                If not given, they are drawn in batches.
     '''
-    def __init__(self, gamma = 0.95, epsilon = 0.2, decay = 1, min_epsilon = 0.1):
+    def __init__(self, gamma = 0.95, epsilon = 0.2, decay = 1, min_epsilon = 0.1, length = None):
         super().__init__()
         self.name = f"QLearning -e: {epsilon} -dec: {decay}"
         self.gamma = gamma 
-        self.epsilon = epsilon
-        self.og_epsilon = epsilon # useful to clone if decay not 1
+        self.og_epsilon = epsilon # the decay starts again from it at each meeting (see epsilon_schedule)
         self.decay = decay
         self.min_epsilon = min_epsilon
-        self.q_table = np.zeros((2,2,2)) # 4 possible states (2x2 actions), 2 possible actions: 4x2
+        self.length = length
+        # random numbers for exploration, drawn in get_action
+        self._uniforms = np.empty(0, dtype=np.float32)
+        self._randbits = np.empty(0, dtype=np.int8)
+        # epsilon used at each game, computed in get_action as it only depends on the parameters
+        self._eps_schedule = np.empty(0)
+        # learning rate alpha = 1/(iteration+1) at each game, computed in get_action.
+        # It is a list as reading single Python floats is faster than reading NumPy scalars
+        self._alpha_table = []
+        self.q_flat = array('f', [0.0] * 8) # 4 possible states (2x2 actions), 2 possible actions: 4x2, stored flat as float32
         # save past actions, initiation is irrelevant to outcome as all entries are 0 in the beginning and first action is chosen randomly
         self.mypast = 0
         self.theirpast = 0
         # flag for last iteration
         self.done = False
+        # last game played, -1 before the first one
+        self.iteration = -1
 
 # to access q_table: first two indices form the state s (my_action, their_action). Third index is the action a.
+# q_flat holds the same values, entry (s, a) being at index (my_action << 2) | (their_action << 1) | a.
+
+    @property
+    def q_table(self):
+        # view of q_flat, so that writes to q_table update it
+        return np.frombuffer(self.q_flat, dtype=np.float32).reshape(2,2,2)
+
+    @property
+    def epsilon(self):
+        # epsilon of the decaying epsilon-greedy policy at the last game played, as in epsilon_schedule
+        if self.iteration < 0:
+            return self.og_epsilon
+        return max(self.min_epsilon, self.og_epsilon * self.decay ** (self.iteration + 1))
 
     def get_action(self, iteration):
-        # decaying epsilon greedy policy
-        self.epsilon = max(self.min_epsilon, self.epsilon*self.decay)
-        # save iteration number to compute alpha later
+        # save iteration number to look up alpha later
         self.iteration = iteration
 
+        # draw new random numbers at the beginning of each meeting, or when they run out
+        if iteration == 0 or iteration >= self._uniforms.size:
+            n = _batch_size(self.length, iteration)
+            self._uniforms = np.random.random(n).astype(np.float32)
+            self._randbits = np.random.randint(0, 2, n, dtype=np.int8)
+            if self._eps_schedule.size < n:
+                self._eps_schedule = self.epsilon_schedule(n)
+            if len(self._alpha_table) < n:
+                self._alpha_table = self.learning_rates(n).tolist()
+
         # initialise first state, so first action, randomly
-        if (iteration == 0) or (np.random.uniform(0,1) < self.epsilon):
+        if (iteration == 0) or (self._uniforms[iteration] < self._eps_schedule[iteration]):
             # choose random action
-            action = np.random.choice([0, 1])
+            action = int(self._randbits[iteration])
         else:
-            # select action that maximises Q table for last state
-            action = np.argmax(self.q_table[self.mypast][self.theirpast])
+            # select action that maximises Q table for last state (cooperate on ties, as np.argmax)
+            state = (self.mypast << 2) | (self.theirpast << 1)
+            action = 1 if self.q_flat[state | 1] > self.q_flat[state] else 0
         return action
 
+    def epsilon_schedule(self, n):
+        '''
+        Decaying epsilon of the first 'n' games: at each game epsilon is multiplied by 'decay', down to 'min_epsilon'.
+        '''
+        return np.maximum(self.min_epsilon, self.og_epsilon * self.decay ** np.arange(1, n + 1, dtype=np.float64))
+
+    def learning_rates(self, n):
+        '''
+        Learning rate alpha = 1/(iteration+1) of the first 'n' games.
+        '''
+        return 1.0 / np.arange(1, n + 1, dtype=np.float32)
+
     def update(self, my, their):
-        # calculate rewards and update Q table with current actions
+        # calculate rewards and update Q table in place with current actions
         r = self.step(my, their)
-        self.q_table = self.single_step_update(my, their, r) 
+        self.single_step_update(my, their, r)
         # current actions become past actions for next game
         self.mypast = my
         self.theirpast = their
@@ -139,17 +210,20 @@ class QLearning(Strategy):
         return r
 
     def single_step_update(self, my, their, r): 
+        q = self.q_flat
+        # entry of the past state and current action, and first entry of the current state
+        idx = (self.mypast << 2) | (self.theirpast << 1) | my
+        state = (my << 2) | (their << 1)
         if self.done: 
-            deltaQ = r + 0 - self.q_table[self.mypast][self.theirpast][my]
+            deltaQ = r + 0 - q[idx]
         else:
             # Q-learning update
-            deltaQ = r + self.gamma * self.q_table[my][their].max() - self.q_table[self.mypast][self.theirpast][my]
-        alpha = 1/(self.iteration +1)
-        self.q_table[self.mypast][self.theirpast][my] += alpha * deltaQ
-        return self.q_table
+            deltaQ = r + self.gamma * max(q[state], q[state | 1]) - q[idx]
+        alpha = self._alpha_table[self.iteration]
+        q[idx] += alpha * deltaQ
 
     def clone(self):
-        return QLearning(self.gamma, self.og_epsilon, self.decay)
+        return QLearning(self.gamma, self.og_epsilon, self.decay, length=self.length)
 
     def print_qtable(self):
         return self.q_table
\ No newline at end of file
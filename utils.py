@@ -1,6 +1,49 @@
 import numpy as np
 import math
+import random
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
+from strategy import Cooperate, Defect, Random, TitforTat, QLearning
+
+# the compiled meeting between two QLearning players needs numba, otherwise they play game by game
+try:
+    from numba_meeting import run_meeting_ql_ql
+except ImportError:
+    run_meeting_ql_ql = None
+
+# the compiled game loop for any pair of strategies needs Cython and a C compiler, otherwise it runs in Python
+try:
+    import pyximport
+    _importers = pyximport.install(language_level=3)
+    try:
+        from _meeting_core import run_scalar
+    finally:
+        pyximport.uninstall(*_importers)
+except ImportError:
+    run_scalar = None
+
+# progress bar of run_many, if available
+try:
+    from tqdm import tqdm
+except ImportError:
+    tqdm = None
+
+# strategies whose actions do not depend on anything the opponent learns,
+# so a whole meeting between two of them can be computed at once
+FIXED_STRATEGIES = (Cooperate, Defect, Random, TitforTat)
+
+
+def _payoff_matrix(payoffs):
+    """ payoff matrix as int32 if all payoffs are integers (as the compiled game loop needs), as float64 otherwise. """
+    matrix = np.array(payoffs, dtype=np.float64)
+    as_int = matrix.astype(np.int32)
+    return as_int if np.array_equal(as_int, matrix) else matrix
+
+
+def _rounds_str(rounds):
+    """ history of actions as a string of actions separated by spaces. """
+    return np.array2string(rounds, separator=' ', max_line_width=np.inf, threshold=rounds.size + 1)[1:-1]
+
 
 class Game:
     """
@@ -11,8 +54,21 @@ class Game:
     def __init__(self, payoff, actions):
         self.actions = actions
         self.size = int(math.sqrt(len(payoff)))
-        self.scores = np.array(payoff, dtype=[("x", object), ("y", object)])
         self.payoff = payoff 
+        # scores of the row (x) and column (y) player as matrices, of integers unless some payoffs are not
+        self.scores_x = _payoff_matrix([[t[0] for t in row] for row in payoff])
+        self.scores_y = _payoff_matrix([[t[1] for t in row] for row in payoff])
+
+    @property
+    def scores(self):
+        """ scores of both players as a single array with fields "x" and "y", of the same type as scores_x and scores_y.
+        It is a read-only copy built from scores_x and scores_y, which are the matrices to modify.
+        """
+        scores = np.empty(self.scores_x.shape, dtype=[("x", self.scores_x.dtype), ("y", self.scores_y.dtype)])
+        scores["x"] = self.scores_x
+        scores["y"] = self.scores_y
+        scores.flags.writeable = False
+        return scores
 
     def getNash(self):
         """ finds Nash equilibra of the payoff matrix. 
@@ -22,13 +78,10 @@ class Game:
         Returns:
             List: index or indexes of Nash equilibra.
         """
-        max_x = np.matrix(self.scores["x"].max(0)).repeat(self.size, axis=0)
-        bool_x = self.scores["x"] == max_x
-        max_y = (np.matrix(self.scores["y"].max(1)).transpose().repeat(self.size, axis=1))
-        bool_y = self.scores["y"] == max_y
-        bool_x_y = bool_x & bool_y
-        result = np.where(bool_x_y == True)
-        listOfCoordinates = list(zip(result[0], result[1]))
+        # best response of x for each action of y, and of y for each action of x
+        bool_x = self.scores_x == self.scores_x.max(axis=0, keepdims=True)
+        bool_y = self.scores_y == self.scores_y.max(axis=1, keepdims=True)
+        listOfCoordinates = [tuple(ij) for ij in np.argwhere(bool_x & bool_y).tolist()]
         return listOfCoordinates
  
 
@@ -44,6 +97,13 @@ class Meeting:
         self.s1 = s1.clone()
         self.s2 = s2.clone()
         self.length = length
+        # QLearning players draw the random numbers of the whole meeting at once
+        for s in (self.s1, self.s2):
+            if isinstance(s, QLearning):
+                s.length = length
+        # payoffs of each player as integer matrices, indexed directly by the actions
+        self._scores_x = game.scores_x
+        self._scores_y = game.scores_y
         # cooperation counters
         self.num_cooperation_s1 = 0
         self.num_cooperation_s2 = 0
@@ -56,13 +116,142 @@ class Meeting:
         self.s1_score = 0
         self.s2_score = 0
         # history of actions
-        self.s1_rounds = []
-        self.s2_rounds = []
+        self.s1_rounds = np.empty(self.length, dtype=np.int8)
+        self.s2_rounds = np.empty(self.length, dtype=np.int8)
 
     def run(self):
         """
         Run the meeting.
         """
+        # meetings between fixed strategies don't need to be played one game at a time
+        if type(self.s1) in FIXED_STRATEGIES and type(self.s2) in FIXED_STRATEGIES:
+            return self.run_vectorized()
+        if run_meeting_ql_ql is not None and type(self.s1) is QLearning and type(self.s2) is QLearning:
+            return self.run_compiled()
+        # the compiled extension works on integer payoffs only
+        if run_scalar is not None and self._scores_x.dtype == np.int32 and self._scores_y.dtype == np.int32:
+            return self.run_extension()
+        # QLearning vs fixed strategy has a loop specialized for the opponent. As the compiled extension plays
+        # these meetings first, it only runs when the extension is not available or the payoffs are not integers
+        if ((type(self.s1) is QLearning and type(self.s2) in FIXED_STRATEGIES) or
+                (type(self.s2) is QLearning and type(self.s1) in FIXED_STRATEGIES)):
+            return self.run_learner()
+
+        # reset meeting scores
+        self.reinit()
+
+        # comunicate payoff matrix to players
+        s1 = self.s1
+        s2 = self.s2
+        s1.payoff = self.game.payoff
+        s2.payoff = self.game.payoff
+
+        # bind everything used in the loop to local variables
+        get_a1 = s1.get_action
+        get_a2 = s2.get_action
+        upd1 = s1.update
+        upd2 = s2.update
+        scores_x = self._scores_x.tolist()
+        scores_y = self._scores_y.tolist()
+        s1_rounds = self.s1_rounds
+        s2_rounds = self.s2_rounds
+
+        def play(games):
+            # play 'games', returning the cumulative reward of each player
+            s1_score = 0
+            s2_score = 0
+            for iteration in games:
+                # get each players' action
+                c1 = get_a1(iteration)
+                c2 = get_a2(iteration)
+                # save action in history
+                s1_rounds[iteration] = c1
+                s2_rounds[iteration] = c2
+                # tell each other their past action
+                upd1(c1, c2)
+                upd2(c2, c1)
+                # add payoff to cumulative reward, actions are the indexes of the payoff matrix
+                s1_score += scores_x[c1][c2]
+                s2_score += scores_y[c1][c2]
+            return s1_score, s2_score
+
+        # run 'length' games: all but the last one, then the last one after setting players' 'done' flag to True
+        self.s1_score, self.s2_score = play(range(self.length - 1))
+        if self.length:
+            s1.done = True
+            s2.done = True
+            s1_score, s2_score = play(range(self.length - 1, self.length))
+            self.s1_score += s1_score
+            self.s2_score += s2_score
+
+        # add cooperations to the cooperation counters
+        self.num_cooperation_s1 += int((s1_rounds == 0).sum())
+        self.num_cooperation_s2 += int((s2_rounds == 0).sum())
+
+    def run_vectorized(self):
+        """
+        Run the meeting between two fixed strategies, computing all the games at once.
+        """
+        # reset meeting scores
+        self.reinit()
+
+        c1 = self._fixed_rounds(self.s1)
+        c2 = self._fixed_rounds(self.s2)
+        # TitforTat plays the opponent's previous action, starting with cooperation
+        if c1 is None and c2 is None:
+            c1 = np.zeros(self.length, dtype=np.int8)
+            c2 = np.zeros(self.length, dtype=np.int8)
+        elif c1 is None:
+            c1 = np.zeros(self.length, dtype=np.int8)
+            c1[1:] = c2[:-1]
+        elif c2 is None:
+            c2 = np.zeros(self.length, dtype=np.int8)
+            c2[1:] = c1[:-1]
+        for s, their in [(self.s1, c2), (self.s2, c1)]:
+            if isinstance(s, TitforTat) and self.length > 0:
+                s.theirPast = int(their[-1])
+
+        # count cooperations
+        self.num_cooperation_s1 += int((c1 == 0).sum())
+        self.num_cooperation_s2 += int((c2 == 0).sum())
+        # save history
+        self.s1_rounds = c1
+        self.s2_rounds = c2
+        # add payoff of every game to cumulative reward, actions are the indexes of the payoff matrix
+        self.s1_score = self._scores_x[c1, c2].sum().item()
+        self.s2_score = self._scores_y[c1, c2].sum().item()
+
+    def run_compiled(self):
+        """
+        Run the meeting between two QLearning players as a single compiled loop.
+        """
+        # reset meeting scores
+        self.reinit()
+
+        s1, s2 = self.s1, self.s2
+        s1.payoff = s2.payoff = self.game.payoff
+        params1, past1 = self._kernel_params(s1)
+        params2, past2 = self._kernel_params(s2)
+        (score1, score2, coop1, coop2, c1, c2) = run_meeting_ql_ql(
+            self._scores_x, self._scores_y, self.length, params1, params2, past1, past2, bool(s1.done), bool(s2.done))
+        # Q tables and past actions were updated in place, restore the rest of the players' state
+        for s, past in [(s1, past1), (s2, past2)]:
+            s.mypast, s.theirpast = int(past[0]), int(past[1])
+            if self.length > 0:
+                s.iteration = self.length - 1
+                s.done = True
+
+        self.num_cooperation_s1 += coop1
+        self.num_cooperation_s2 += coop2
+        self.s1_rounds = c1
+        self.s2_rounds = c2
+        self.s1_score = score1
+        self.s2_score = score2
+
+    def run_extension(self):
+        """
+        Run the meeting with the game loop of the compiled extension _meeting_core.
+        """
         # reset meeting scores
         self.reinit()
 
@@ -70,38 +259,132 @@ class Meeting:
         self.s1.payoff = self.game.payoff
         self.s2.payoff = self.game.payoff
 
-        # run 'length' games
-        for iteration in range(self.length):
-            # if it is the last game, set players' 'done' flag to True
-            if iteration == self.length -1:
-                self.s1.done = True
-                self.s2.done = True
-            # get each players' action
-            c1 = self.s1.get_action(iteration)
-            c2 = self.s2.get_action(iteration)
-            # if they choose to cooperate, add to the cooperation counter
-            if c1 == 0:
-                self.num_cooperation_s1 += 1
-            if c2 == 0:
-                self.num_cooperation_s2 += 1
-            # save action in history list
-            self.s1_rounds.append(c1)
-            self.s2_rounds.append(c2)
-            # tell each other their past action
-            self.s1.update(c1, c2)
-            self.s2.update(c2, c1)
-            act = self.game.actions
-            # add payoff to cumulative reward
-            self.s1_score += self.game.scores["x"][act.index(c1), act.index(c2)]
-            self.s2_score += self.game.scores["y"][act.index(c1), act.index(c2)]
+        score1, score2, c1, c2 = run_scalar(self._scores_x, self._scores_y, self.length, self.s1, self.s2)
+        self.num_cooperation_s1 += int((c1 == 0).sum())
+        self.num_cooperation_s2 += int((c2 == 0).sum())
+        self.s1_rounds = c1
+        self.s2_rounds = c2
+        self.s1_score = int(score1)
+        self.s2_score = int(score2)
+
+    def run_learner(self):
+        """
+        Run the meeting between a QLearning player and a fixed strategy, with the loop specialized for the pair.
+        """
+        # reset meeting scores
+        self.reinit()
+
+        learner_first = type(self.s1) is QLearning
+        ql, opp = (self.s1, self.s2) if learner_first else (self.s2, self.s1)
+        ql.payoff = opp.payoff = self.game.payoff
+        ql_rounds, opp_rounds = self._learner_rounds(ql, opp)
+        if isinstance(opp, TitforTat) and self.length > 0:
+            opp.theirPast = int(ql_rounds[-1])
+        c1, c2 = (ql_rounds, opp_rounds) if learner_first else (opp_rounds, ql_rounds)
+
+        # count cooperations
+        self.num_cooperation_s1 += int((c1 == 0).sum())
+        self.num_cooperation_s2 += int((c2 == 0).sum())
+        # save history
+        self.s1_rounds = c1
+        self.s2_rounds = c2
+        # add payoff of every game to cumulative reward, actions are the indexes of the payoff matrix
+        self.s1_score = self._scores_x[c1, c2].sum().item()
+        self.s2_score = self._scores_y[c1, c2].sum().item()
+
+    def _learner_rounds(self, ql, opp):
+        """
+        Play the games between QLearning player 'ql' and fixed strategy 'opp', with QLearning.get_action and
+        QLearning.update written inline.
+
+        Returns:
+            Tuple: history of actions of the two players.
+        """
+        length = self.length
+        # actions of the opponent are known in advance, except for TitforTat that plays the QLearning player's past action
+        opp_rounds = self._fixed_rounds(opp)
+        theirs = None if opp_rounds is None else opp_rounds.tolist()
+        mine = [0] * length
+        # random numbers of the epsilon-greedy policy and rewards of the QLearning player
+        uniforms = np.random.random(length).tolist()
+        randbits = np.random.randint(0, 2, length).tolist()
+        eps = ql.epsilon_schedule(length).tolist()
+        alphas = ql.learning_rates(length).tolist()
+        rewards = self._scores_x.tolist()
+        q = ql.q_flat
+        gamma = ql.gamma
+
+        def play(games, done, mypast, theirpast):
+            # play 'games' with the given 'done' flag, returning the past actions after the last one
+            for iteration in games:
+                if iteration == 0 or uniforms[iteration] < eps[iteration]:
+                    my = randbits[iteration]
+                else:
+                    state = (mypast << 2) | (theirpast << 1)
+                    my = 1 if q[state | 1] > q[state] else 0
+                if theirs is None:
+                    # TitforTat cooperates on the first game
+                    their = mypast if iteration else 0
+                else:
+                    their = theirs[iteration]
+                mine[iteration] = my
+                # Q-learning update
+                idx = (mypast << 2) | (theirpast << 1) | my
+                if done:
+                    deltaQ = rewards[my][their] - q[idx]
+                else:
+                    state = (my << 2) | (their << 1)
+                    deltaQ = rewards[my][their] + gamma * max(q[state], q[state | 1]) - q[idx]
+                q[idx] += alphas[iteration] * deltaQ
+                mypast, theirpast = my, their
+            return mypast, theirpast
+
+        # all games but the last one, then the last one after setting the 'done' flag to True
+        mypast, theirpast = play(range(length - 1), ql.done, ql.mypast, ql.theirpast)
+        if length:
+            ql.done = True
+            mypast, theirpast = play(range(length - 1, length), True, mypast, theirpast)
+            ql.iteration = length - 1
+
+        ql.mypast, ql.theirpast = mypast, theirpast
+        mine = np.array(mine, dtype=np.int8)
+        if opp_rounds is None:
+            opp_rounds = np.zeros(length, dtype=np.int8)
+            opp_rounds[1:] = mine[:-1]
+        return mine, opp_rounds
+
+    def _kernel_params(self, s):
+        """
+        Parameters of a QLearning player for the compiled meeting: the tuple of its Q table (shared with the player),
+        gamma and tables of the games, and the array of its past actions, updated in place by the meeting.
+        """
+        # random numbers of the epsilon-greedy policy, drawn from np.random so that seeding it reproduces the meeting
+        uniforms = np.random.random(self.length)
+        randbits = np.random.randint(0, 2, self.length, dtype=np.int8)
+        params = (np.frombuffer(s.q_flat, dtype=np.float32), float(s.gamma), s.epsilon_schedule(self.length),
+                  s.learning_rates(self.length), uniforms, randbits)
+        past = np.array([s.mypast, s.theirpast], dtype=np.int64)
+        return params, past
+
+    def _fixed_rounds(self, s):
+        """
+        Actions played by a fixed strategy in the whole meeting, None for TitforTat as it depends on the opponent.
+        """
+        if isinstance(s, Cooperate):
+            return np.full(self.length, 0, dtype=np.int8)
+        if isinstance(s, Defect):
+            return np.full(self.length, 1, dtype=np.int8)
+        if isinstance(s, Random):
+            return np.random.randint(0, 2, size=self.length, dtype=np.int8)
+        return None
 
     def pretty_print(self, max=50):
         '''
         Print the outcome of the meeting, as the outcome of the first (max 'max') games and the cumulative scores.
         The score is the sum of the scores obtained on each game, according to the payoff matrix. The higher the better.
         '''
-        print("{}\t{} ... {} = {}".format(self.s1.name, ' '.join(map(str, self.s1_rounds[:max//2])), ' '.join(map(str, self.s1_rounds[-max//2:])), self.s1_score))
-        print("{}\t{} ... {} = {}".format(self.s2.name, ' '.join(map(str, self.s2_rounds[:max//2])), ' '.join(map(str, self.s2_rounds[-max//2:])), self.s2_score))
+        print("{}\t{} ... {} = {}".format(self.s1.name, _rounds_str(self.s1_rounds[:max//2]), _rounds_str(self.s1_rounds[-max//2:]), self.s1_score))
+        print("{}\t{} ... {} = {}".format(self.s2.name, _rounds_str(self.s2_rounds[:max//2]), _rounds_str(self.s2_rounds[-max//2:]), self.s2_score))
 
     def plot_cooperation(self):
         '''
@@ -110,18 +393,13 @@ class Meeting:
         # set size
         plt.rcParams["figure.figsize"] = (10,7)
 
-        s1_cooperations_count = [0]
-        s2_cooperations_count = [0]
-        s1_cooperations_percent = []
-        s2_cooperations_percent = []
-
-        for i in range(self.length):
-            # count cooperations until time i 
-            s1_cooperations_count.append(s1_cooperations_count[-1] + self.s1_rounds[i])
-            s2_cooperations_count.append(s2_cooperations_count[-1] + self.s2_rounds[i])
-            # make it a percentage over amount of actions taken
-            s1_cooperations_percent.append(s1_cooperations_count[-1]/(i+1) * 100)
-            s2_cooperations_percent.append(s2_cooperations_count[-1]/(i+1) * 100)
+        # count cooperations until time i 
+        s1_cooperations_count = np.cumsum(self.s1_rounds == 0)
+        s2_cooperations_count = np.cumsum(self.s2_rounds == 0)
+        # make it a percentage over amount of actions taken
+        games = np.arange(1, self.length + 1)
+        s1_cooperations_percent = s1_cooperations_count / games * 100
+        s2_cooperations_percent = s2_cooperations_count / games * 100
 
         # plot as lines
         for coop in [s1_cooperations_percent, s2_cooperations_percent]:
@@ -131,4 +409,39 @@ class Meeting:
         plt.xlabel('game');
         plt.ylabel('percentage');
         plt.title("Number of cooperations");
-        plt.legend([self.s1.name, self.s2.name]);
\ No newline at end of file
+        plt.legend([self.s1.name, self.s2.name]);
+
+
+def _run_meeting(task):
+    # worker of run_many: play a single meeting with its own seed
+    index, game, s1, s2, length, seed = task
+    random.seed(seed)
+    np.random.seed(seed)
+    m = Meeting(game, s1, s2, length)
+    m.run()
+    q_tables = tuple(s.print_qtable() if isinstance(s, QLearning) else None for s in (m.s1, m.s2))
+    return index, (m.s1_score, m.s2_score, m.num_cooperation_s1, m.num_cooperation_s2, q_tables)
+
+
+def run_many(meetings, processes=None, seed=None):
+    """
+    Run many meetings in parallel, each one in a process of a multiprocessing pool. It needs:
+        - meetings: list of objects of class Meeting, they are not modified
+        - processes (optional): number of worker processes. Defaults to the number of CPUs.
+        - seed (optional): seed from which the seed of each meeting is drawn, to make the results reproducible
+
+    Returns:
+        List: for each meeting, in the same order, the tuple 
+              (s1_score, s2_score, num_cooperation_s1, num_cooperation_s2, (s1_qtable, s2_qtable)), 
+              the Q table being None for players that are not QLearning.
+    """
+    seeds = np.random.default_rng(seed).integers(2**32, size=len(meetings))
+    tasks = [(i, m.game, m.s1, m.s2, m.length, int(seeds[i])) for i, m in enumerate(meetings)]
+    results = [None] * len(tasks)
+    with Pool(processes) as pool:
+        outcomes = pool.imap_unordered(_run_meeting, tasks)
+        if tqdm is not None:
+            outcomes = tqdm(outcomes, total=len(tasks))
+        for index, outcome in outcomes:
+            results[index] = outcome
+    return results